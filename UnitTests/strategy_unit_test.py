@@ -0,0 +1,88 @@
+""" Unit tests for training the variational autoencoder under a distribution strategy.
+
+The single CPU is split into two logical devices so the models can be mirrored across two replicas. The split is only
+possible before TensorFlow initializes its runtime, so these tests are skipped when another test module has already
+run TensorFlow in the same process. Run this module on its own to be sure they run.
+
+"""
+
+import unittest
+import os
+import numpy as np
+import tensorflow as tf
+from models.vae_models import VAE, create_vae_encoder, create_vae_decoder
+from modelUtils.vae_utils import create_param_df, VAECrossValidatorDF
+from utils import generate_data
+
+strategy = None
+
+
+def setUpModule():
+    global strategy
+    try:
+        tf.config.set_logical_device_configuration(tf.config.list_physical_devices('CPU')[0],
+                                                   [tf.config.LogicalDeviceConfiguration()] * 2)
+    except RuntimeError:
+        raise unittest.SkipTest("The TensorFlow runtime is already initialized, so the CPU cannot be split into two "
+                                "logical devices")
+    # A single strategy is shared, since separate strategies over the same devices reuse collective instance keys
+    cpus = tf.config.list_logical_devices('CPU')
+    strategy = tf.distribute.MirroredStrategy([cpus[0].name, cpus[1].name])
+
+
+class TestTwoReplicaVAE(unittest.TestCase):
+    def setUp(self):
+        filepath = os.path.join(os.getcwd(), 'data/cleaned_data/megasample_cleaned.csv')
+        self.train_data, val_data, test_data, feat_labels = generate_data(filepath, subset='thickness')
+        self.h_dim = [100, 100]
+        self.z_dim = 20
+        self.input_dim = self.train_data.element_spec[0].shape[0]
+        self.batch_size = 128
+
+    def test_two_replica_steps(self):
+        data = self.train_data.batch(self.batch_size).take(3)
+        vae = VAE(create_vae_encoder(self.input_dim, self.h_dim, self.z_dim),
+                  create_vae_decoder(self.z_dim, self.h_dim, self.input_dim), cov=False)
+        vae.compile()
+        with strategy.scope():
+            encoder = create_vae_encoder(self.input_dim, self.h_dim, self.z_dim)
+            decoder = create_vae_decoder(self.z_dim, self.h_dim, self.input_dim)
+            mirrored_vae = VAE(encoder, decoder, cov=False)
+            mirrored_vae.compile()
+        mirrored_vae.set_weights(vae.get_weights())
+
+        # The KL divergence does not depend on the latent sample when evaluating, so both must agree
+        expected = vae.evaluate(data, verbose=0, return_dict=True)
+        results = mirrored_vae.evaluate(data, verbose=0, return_dict=True)
+        self.assertAlmostEqual(results['kl_loss'], expected['kl_loss'], places=4)
+        self.assertEqual(np.shape(results['r2_feat']), (self.input_dim,))
+
+        hist = mirrored_vae.fit(data, epochs=1, verbose=0)
+        self.assertAlmostEqual(hist.history['lr'][-1], 1e-4)
+        self.assertEqual(hist.history['beta'][-1], 1)
+        # The loss passed to compile is not modified
+        self.assertEqual(mirrored_vae.reconstruction_loss_fn.reduction, tf.keras.losses.Reduction.AUTO)
+
+
+class TestTwoReplicaCrossValidation(unittest.TestCase):
+    def setUp(self) -> None:
+        self.datapath = os.path.join(os.getcwd(), 'data/cleaned_data/megasample_cleaned.csv')
+
+    def test_cross_validate_two_replicas(self):
+        params = create_param_df(batch_size=[64], epochs=[2])
+        cv_df = VAECrossValidatorDF(params, k_folds=2, test_mode=True, strategy=strategy, jit_compile=True)
+        results = cv_df.cross_validate(self.datapath)
+
+        self.assertEqual(len(results), 1)
+        n_features = cv_df.train_val_vae_params[0]['train_data'].element_spec[0].shape[1]
+        self.assertEqual(results['avg_val_feature_r2'][0].shape, (n_features,))
+        for call in cv_df.train_val_vae_params:
+            model = call['vae']
+            self.assertIs(model.distribute_strategy, strategy)
+            self.assertFalse(model.jit_compile)
+            for x, y in call['train_data'].take(1):
+                self.assertEqual(x.shape[0], 64 * strategy.num_replicas_in_sync)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,8 @@
 import unittest
-from utils import generate_data
+import shutil
+from unittest.mock import patch
+import utils
+from utils import generate_data, one_hot_encode, _read_csv
 import os
 import pandas as pd
 import numpy as np
@@ -462,5 +465,58 @@ class TestGenerateData(unittest.TestCase):
         with self.assertRaises(ValueError):
             generate_data(self.filepath, subset='all', normalize=4)
 
+    def test_one_hot_encode(self):
+        # Test if the one-hot encoding matches sklearn's OneHotEncoder for the sex and rounded age covariates.
+        raw = pd.read_csv(self.filepath)
+        ages_with_nan = np.round(raw['age'].to_numpy())
+        ages_with_nan[[3, 10, 500]] = np.nan
+        for values in [raw['sex'].to_numpy(), np.round(raw['age'].to_numpy()), ages_with_nan]:
+            expected = OneHotEncoder(sparse_output=False).fit_transform(values.reshape(-1, 1))
+            np.testing.assert_array_equal(one_hot_encode(values), expected)
+
+    def test_generate_data_cache_dir(self):
+        # Test if the preprocessed data is saved once and loaded unchanged by later calls.
+        cache_dir = os.path.join(os.getcwd(), 'outputs/data_cache')
+        try:
+            expected = generate_data(self.filepath, subset='thickness', normalize=2)
+            saved = generate_data(self.filepath, subset='thickness', normalize=2, cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            with patch('utils._preprocess_data') as preprocess:
+                loaded = generate_data(self.filepath, subset='thickness', normalize=2, cache_dir=cache_dir)
+                preprocess.assert_not_called()
+            for result in [saved, loaded]:
+                for dataset, expected_dataset in zip(result[:3], expected[:3]):
+                    for tensor, expected_tensor in zip(next(iter(dataset.batch(10000))),
+                                                       next(iter(expected_dataset.batch(10000)))):
+                        self.assertEqual(tensor.dtype, expected_tensor.dtype)
+                        np.testing.assert_array_equal(tensor.numpy(), expected_tensor.numpy())
+                pd.testing.assert_index_equal(result[3], expected[3])
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def test_generate_data_cache_dir_version(self):
+        # Test if files saved by another preprocessing version are ignored, and a failed save leaves no file behind.
+        cache_dir = os.path.join(os.getcwd(), 'outputs/data_cache')
+        try:
+            with patch('numpy.savez', side_effect=OSError):
+                with self.assertRaises(OSError):
+                    generate_data(self.filepath, subset='thickness', cache_dir=cache_dir)
+            self.assertEqual(os.listdir(cache_dir), [])
+            generate_data(self.filepath, subset='thickness', cache_dir=cache_dir)
+            with patch('utils.PREPROCESSED_VERSION', utils.PREPROCESSED_VERSION + 1):
+                with patch('utils._preprocess_data', wraps=utils._preprocess_data) as preprocess:
+                    generate_data(self.filepath, subset='thickness', cache_dir=cache_dir)
+                    preprocess.assert_called_once()
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def test_read_csv_cache(self):
+        # Test if the parsed csv is reused between calls and left unchanged by generate_data.
+        first = _read_csv(self.filepath)
+        generate_data(self.filepath, subset='thickness', normalize=2)
+        self.assertIs(_read_csv(self.filepath), first)
+        pd.testing.assert_frame_equal(first, pd.read_csv(self.filepath))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
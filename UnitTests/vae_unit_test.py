@@ -10,12 +10,13 @@ vae_utils.py.
 import unittest
 import numpy as np
 import tensorflow as tf
-from models.vae_models import VAE, calc_kl_loss, create_vae_encoder, create_vae_decoder, r2_feat_score, r2_score
+from models.vae_models import VAE, calc_kl_loss, create_vae_encoder, create_vae_decoder, r2_feat_score, r2_score, \
+    sample_latent
 import os
 from utils import generate_data
 from modelUtils.lr_utils import MultiOptimizerLearningRateScheduler, CyclicLR, ExponentialDecayScheduler
 from modelUtils.vae_utils import train_val_vae, create_vae, VAECrossValidator, save_vae, load_vae, \
-    get_filename_from_params, create_param_grid, load_or_train_model, create_param_df, VAECrossValidatorDF
+    get_filename_from_params, create_param_grid, load_or_train_model, create_param_df, VAECrossValidatorDF, calc_r2_feat
 import vis_utils as vu
 import shutil
 from vaeModelAnalyzer import VAEModelAnalyzer
@@ -23,7 +24,6 @@ import matplotlib.pyplot as plt
 from unittest.mock import patch
 import pandas as pd
 
-
 class TestVAEModel(unittest.TestCase):
     def setUp(self):
         cur = os.getcwd()
@@ -105,6 +105,16 @@ class TestVAEModel(unittest.TestCase):
         self.assertEqual(z_mean.shape, (self.batch_size, self.z_dim))
         self.assertEqual(z_log_var.shape, (self.batch_size, self.z_dim))
 
+    def test_vae_seeded_sampling(self):
+        data = next(iter(self.train_data.batch(self.batch_size)))
+        vae_a = VAE(self.encoder, self.decoder, cov=False, seed=42)
+        vae_b = VAE(self.encoder, self.decoder, cov=False, seed=42)
+        _, _, z_a, _ = vae_a(data)
+        _, _, z_b, _ = vae_b(data)
+        np.testing.assert_array_equal(z_a.numpy(), z_b.numpy())
+        _, _, z_a_next, _ = vae_a(data)
+        self.assertFalse(np.array_equal(z_a.numpy(), z_a_next.numpy()))
+
     def test_vae_reconstruction_loss(self):
         train_data = self.train_data.batch(self.batch_size)
         train_batches = iter(train_data)
@@ -125,6 +135,27 @@ class TestVAEModel(unittest.TestCase):
         est_loss = tf.reduce_mean(-0.5 * tf.reduce_sum(1 + z_log_var - tf.square(z_mean) - tf.exp(z_log_var), axis=1))
         self.assertAlmostEqual(loss.numpy(), est_loss.numpy())
 
+    def test_sample_latent(self):
+        z_mean = tf.random.normal(shape=(self.batch_size, self.z_dim))
+        z_log_var = tf.random.normal(shape=(self.batch_size, self.z_dim))
+        epsilon = tf.random.normal(shape=(self.batch_size, self.z_dim))
+        z, kl = sample_latent(z_mean, z_log_var, epsilon)
+        self.assertEqual(kl.shape, (self.batch_size,))
+        np.testing.assert_allclose(z.numpy(), (z_mean + tf.exp(0.5 * z_log_var) * epsilon).numpy(), rtol=1e-5, atol=1e-5)
+        self.assertAlmostEqual(tf.reduce_mean(kl).numpy(), calc_kl_loss(z_mean, z_log_var).numpy(), places=4)
+
+    def test_sample_latent_clips_log_var(self):
+        z_mean = tf.zeros(shape=(self.batch_size, self.z_dim))
+        z_log_var = tf.fill((self.batch_size, self.z_dim), 30.0)
+        epsilon = tf.ones(shape=(self.batch_size, self.z_dim))
+        with tf.GradientTape() as tape:
+            tape.watch(z_log_var)
+            z, kl = sample_latent(z_mean, z_log_var, epsilon)
+        np.testing.assert_allclose(z.numpy(), np.exp(5.0), rtol=1e-6)
+        # The KL divergence is not clipped, so it still pushes the log variance down
+        np.testing.assert_allclose(tf.reduce_mean(kl).numpy(), calc_kl_loss(z_mean, z_log_var).numpy(), rtol=1e-6)
+        self.assertTrue(np.all(tape.gradient(kl, z_log_var).numpy() > 0))
+
     def test_r2_feat_score(self):
         actual = tf.constant([[1.0, 2.0, 3.0],
                               [4.0, 5.0, 6.0],
@@ -168,6 +199,24 @@ class TestVAEModel(unittest.TestCase):
         self.assertIsInstance(self.vae.reconstruction_loss_fn, tf.keras.losses.MeanAbsoluteError)
         self.assertIsInstance(self.vae.kl_loss_fn, tf.keras.losses.MeanSquaredError)
 
+    def test_mixed_precision(self):
+        tf.keras.mixed_precision.set_global_policy('mixed_float16')
+        try:
+            encoder = create_vae_encoder(self.input_dim, self.h_dim, self.z_dim)
+            decoder = create_vae_decoder(self.z_dim, self.h_dim, self.input_dim)
+            vae = VAE(encoder, decoder, cov=False)
+            vae.compile()
+            self.assertIsInstance(vae.optimizer, tf.keras.mixed_precision.LossScaleOptimizer)
+            train_data = self.train_data.batch(self.batch_size)
+            hist = vae.fit(train_data.take(2), epochs=1, verbose=0)
+            self.assertTrue(np.isfinite(hist.history['total_loss'][-1]))
+            z_mean, z_log_var, z, x_hat = vae(next(iter(train_data)))
+            self.assertEqual(z_mean.dtype, tf.float32)
+            self.assertEqual(z_log_var.dtype, tf.float32)
+            self.assertEqual(x_hat.dtype, tf.float32)
+        finally:
+            tf.keras.mixed_precision.set_global_policy('float32')
+
     def test_gradients_applied(self):
         # Create a simple dataset
         train_data = self.train_data.batch(self.batch_size)
@@ -259,6 +308,20 @@ class TestVAEUtils(unittest.TestCase):
         self.step_size = 20
         self.decay_rate = 0.9
 
+    def test_calc_r2_feat(self):
+        # Deterministic reconstruction so the batched and full-set scores can be compared
+        def reconstruct(data, training=False):
+            x, y = data
+            x_reconstructed = 0.9 * tf.cast(x, dtype=tf.float32) + 0.1
+            return None, None, None, x_reconstructed
+
+        r2 = calc_r2_feat(reconstruct, self.val_data, batch_size=50)
+        x, y = next(iter(self.val_data.batch(self.val_data.cardinality().numpy())))
+        _, _, _, x_reconstructed = reconstruct((x, y))
+        expected = r2_feat_score(tf.cast(x, dtype=tf.float32), x_reconstructed).numpy()
+        self.assertEqual(r2.shape, (self.input_dim,))
+        np.testing.assert_allclose(r2, expected, rtol=1e-4, atol=1e-5)
+
     def test_save_vae(self):
         self.vae.compile()
         savefile = os.path.join(os.getcwd(), '../outputs/models/vae/test')
@@ -515,6 +578,17 @@ class TestVAEAnalyzer(unittest.TestCase):
         self.assertTrue(os.path.exists(os.path.join(save_path, 'full_stack.png')))
         shutil.rmtree(save_path)
 
+    def test_full_stack_single_forward_pass(self):
+        analyzer = VAEModelAnalyzer(self.model, self.data, self.z_dim, self.feat_labels)
+        save_path = os.path.join(os.getcwd(), 'outputs/models/vae/test')
+        if not os.path.exists(save_path):
+            os.makedirs(save_path)
+        with patch.object(self.model, 'call', wraps=self.model.call) as call:
+            analyzer.full_stack(save_path)
+        # One shared pass for the visualizations and one for the R2, as the validation data fits in a single batch
+        self.assertEqual(call.call_count, 2)
+        shutil.rmtree(save_path)
+
     def test_full_stack_hist(self):
         analyzer = VAEModelAnalyzer(self.model, self.data, self.z_dim, self.feat_labels, hist=self.hist)
         save_path = os.path.join(os.getcwd(), 'outputs/models/vae/test')
@@ -817,6 +891,29 @@ class TestCrossValidationDF(unittest.TestCase):
         cv_df = VAECrossValidatorDF(params)
         self.assertIsInstance(cv_df, VAECrossValidatorDF)
 
+    def test_create_fold_datasets(self):
+        # Each sample is identified by its first feature
+        n_samples = 1000
+        x = np.tile(np.arange(n_samples, dtype='float64').reshape(-1, 1), (1, 3))
+        y = np.zeros((n_samples, 2), dtype='float32')
+        data = tf.data.Dataset.from_tensor_slices((x, y))
+        cv_df = VAECrossValidatorDF(create_param_df(), k_folds=5)
+        folds = cv_df.create_fold_datasets(data, 64)
+        self.assertEqual(len(folds), 5)
+
+        val_ids = []
+        for train_data, val_data in folds:
+            train_ids = []
+            for x_batch, y_batch in train_data:
+                self.assertEqual(x_batch.shape[0], 64)
+                self.assertEqual(y_batch.shape[0], 64)
+                train_ids.extend(x_batch[:, 0].numpy())
+            fold_val_ids = [x_id for x_batch, _ in val_data for x_id in x_batch[:, 0].numpy()]
+            self.assertFalse(set(train_ids) & set(fold_val_ids))
+            self.assertEqual(len(train_ids), (800 // 64) * 64)
+            val_ids.extend(fold_val_ids)
+        self.assertEqual(sorted(val_ids), list(range(n_samples)))
+
     def test_cross_validate_simple(self):
         params = create_param_df(epochs=[10])
         cv_df = VAECrossValidatorDF(params, k_folds=2, test_mode=True)
@@ -1025,6 +1122,108 @@ class TestCrossValidationDF(unittest.TestCase):
             lr = model.optimizer.lr.numpy()
             self.assertTrue(np.isclose(lr, 0.01, atol=1e-7) or np.isclose(lr, 0.001, atol=1e-7))
 
+    def test_cross_validate_weight_decay(self):
+        params = create_param_df(weight_decay=[1e-4], lr=[0.001], epochs=[2])
+        cv_df = VAECrossValidatorDF(params, k_folds=2, test_mode=True)
+        results = cv_df.cross_validate(self.datapath)
+
+        self.assertEqual(len(results), 1)
+        for call in cv_df.train_val_vae_params:
+            model = call['vae']
+            self.assertIsInstance(model.optimizer, tf.keras.optimizers.AdamW)
+            self.assertAlmostEqual(model.optimizer.weight_decay, 1e-4)
+            self.assertTrue(np.isclose(model.optimizer.lr.numpy(), 0.001))
+
+    def test_cross_validate_reuses_model(self):
+        params = create_param_df(epochs=[1])
+        cv_df = VAECrossValidatorDF(params, k_folds=2, test_mode=True)
+        cv_df.cross_validate(self.datapath)
+
+        self.assertEqual(len(cv_df.train_val_vae_params), 2)
+        first, second = cv_df.train_val_vae_params
+        self.assertIs(first['vae'], second['vae'])
+        # The optimizer restarts for each fold, so it only counts the steps of the last fold
+        steps = len(second['train_data'])
+        self.assertEqual(second['vae'].optimizer.iterations.numpy(), steps)
+
+    def test_cross_validate_reuses_model_mixed_precision(self):
+        params = create_param_df(epochs=[1])
+        cv_df = VAECrossValidatorDF(params, k_folds=2, test_mode=True)
+        fold_states = []
+        train_val_vae_wrapper = cv_df.train_val_vae_wrapper
+
+        def record_state(**kwargs):
+            optimizer = kwargs['vae'].optimizer
+            fold_states.append((optimizer.loss_scale.numpy(), optimizer.dynamic_counter.numpy()))
+            result = train_val_vae_wrapper(**kwargs)
+            # Move the loss scale away from its initial state, so the next fold has to restore it
+            optimizer._loss_scale.current_loss_scale.assign(1.0)
+            optimizer.dynamic_counter.assign(5)
+            return result
+
+        tf.keras.mixed_precision.set_global_policy('mixed_float16')
+        try:
+            with patch.object(cv_df, 'train_val_vae_wrapper', side_effect=record_state):
+                cv_df.cross_validate(self.datapath)
+        finally:
+            tf.keras.mixed_precision.set_global_policy('float32')
+        self.assertIsInstance(cv_df.train_val_vae_params[0]['vae'].optimizer,
+                              tf.keras.mixed_precision.LossScaleOptimizer)
+        self.assertEqual(len(fold_states), 2)
+        self.assertEqual(fold_states[0], fold_states[1])
+
+    def test_cross_validate_seed(self):
+        params = create_param_df(epochs=[1])
+        cv_df = VAECrossValidatorDF(params, k_folds=2, test_mode=True, seed=7)
+        fold_states = []
+        train_val_vae_wrapper = cv_df.train_val_vae_wrapper
+
+        def record_state(**kwargs):
+            fold_states.append(kwargs['vae'].rng.state.numpy())
+            return train_val_vae_wrapper(**kwargs)
+
+        with patch.object(cv_df, 'train_val_vae_wrapper', side_effect=record_state):
+            cv_df.cross_validate(self.datapath)
+        self.assertEqual(len(fold_states), 2)
+        for i, state in enumerate(fold_states):
+            np.testing.assert_array_equal(state, tf.random.Generator.from_seed(7 + i).state.numpy())
+        self.assertEqual(cv_df.kf.random_state, 7)
+        self.assertIsNone(VAECrossValidatorDF(params, seed=None).kf.random_state)
+
+    def test_cross_validate_shares_folds(self):
+        params = create_param_df(lr=[0.001, 0.01], epochs=[1])
+        cv_df = VAECrossValidatorDF(params, k_folds=2, test_mode=True)
+        with patch.object(cv_df, 'create_fold_datasets', wraps=cv_df.create_fold_datasets) as create_folds:
+            cv_df.cross_validate(self.datapath)
+        self.assertEqual(create_folds.call_count, 1)
+        first_row, second_row = cv_df.train_val_vae_params[:2], cv_df.train_val_vae_params[2:]
+        for first, second in zip(first_row, second_row):
+            self.assertIs(first['train_data'], second['train_data'])
+            self.assertIs(first['val_data'], second['val_data'])
+
+    def test_cross_validate_jit_compile(self):
+        params = create_param_df(epochs=[1])
+        cv_df = VAECrossValidatorDF(params, k_folds=2, test_mode=True)
+        cv_df.cross_validate(self.datapath)
+        self.assertFalse(cv_df.train_val_vae_params[0]['vae'].jit_compile)
+
+        cv_df = VAECrossValidatorDF(params, k_folds=2, test_mode=True, jit_compile=True)
+        cv_df.cross_validate(self.datapath)
+        self.assertTrue(cv_df.train_val_vae_params[0]['vae'].jit_compile)
+
+    def test_cross_validate_strategy(self):
+        params = create_param_df(batch_size=[64], epochs=[2])
+        strategy = tf.distribute.MirroredStrategy(['/cpu:0'])
+        cv_df = VAECrossValidatorDF(params, k_folds=2, test_mode=True, strategy=strategy)
+        results = cv_df.cross_validate(self.datapath)
+
+        self.assertEqual(len(results), 1)
+        for call in cv_df.train_val_vae_params:
+            model = call['vae']
+            self.assertIs(model.distribute_strategy, strategy)
+            for x, y in call['train_data'].take(1):
+                self.assertEqual(x.shape[0], 64 * strategy.num_replicas_in_sync)
+
     def test_cross_validate_save(self):
         params = create_param_df(epochs=[10])
         save_path = os.path.join(os.getcwd(), 'outputs/models/test/')
@@ -27,6 +27,10 @@ def __main__():
     parser = argparse.ArgumentParser(description='Run the large cross validation')
     parser.add_argument('--output_dir', type=str, help='Directory where model results will be saved')
     parser.add_argument('--file_path', type=str, help='Path to the data file')
+    parser.add_argument('--mixed_precision', action='store_true', help='Train the models with mixed_float16')
+    parser.add_argument('--jit_compile', action='store_true', help='Compile the train and test steps with XLA')
+    parser.add_argument('--data_cache_dir', type=str, default=None,
+                        help='Directory where the preprocessed data is saved and reused from')
     args = parser.parse_args()
 
     print("Num GPUs Available: ", len(tf.config.list_physical_devices('GPU')))
@@ -46,8 +50,16 @@ def __main__():
         beta=[1e-5], h_dim=[[512, 256]]
         )
 
+    if args.mixed_precision:
+        tf.keras.mixed_precision.set_global_policy('mixed_float16')
+
+    # Mirror each model across the available GPUs
+    strategy = tf.distribute.MirroredStrategy()
+    print("Replicas in sync: ", strategy.num_replicas_in_sync)
+
     # Create the cross validator
-    cv = VAECrossValidatorDF(param_df, save_path=output_dir, k_folds=2)
+    cv = VAECrossValidatorDF(param_df, save_path=output_dir, k_folds=2, strategy=strategy,
+                             jit_compile=args.jit_compile, data_cache_dir=args.data_cache_dir)
     results = cv.cross_validate(datapath=file_path)
 
     if not os.path.exists(output_dir):
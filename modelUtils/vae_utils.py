@@ -110,6 +110,35 @@ def train_val_vae(vae, train_data, val_data, epochs=200, savefile=None, early_st
     return vae, hist
 
 
+def calc_r2_feat(vae, data, batch_size=1024):
+    """ Calculate the feature R2 score of a VAE model over a dataset.
+
+    The reconstructions are generated batch by batch and only the per feature sums needed for the R2 score are kept, so
+    the result matches r2_feat_score over the whole dataset without the dataset having to fit in a single batch.
+
+    Args:
+        vae (VAE): Trained VAE model.
+        data (tf.data.Dataset): Unbatched dataset of (x, y) pairs.
+        batch_size (int): Number of samples to reconstruct at a time.
+
+    Returns: The R2 score of each feature calculated across subjects.
+    """
+    n = 0
+    x_sum = 0.0
+    x_sq_sum = 0.0
+    residual = 0.0
+    for x, y in data.batch(batch_size):
+        _, _, _, x_reconstructed = vae((x, y), training=False)
+        x = tf.cast(x, dtype=tf.float64)
+        x_reconstructed = tf.cast(x_reconstructed, dtype=tf.float64)
+        n += x.shape[0]
+        x_sum += tf.reduce_sum(x, axis=0)
+        x_sq_sum += tf.reduce_sum(tf.square(x), axis=0)
+        residual += tf.reduce_sum(tf.square(x - x_reconstructed), axis=0)
+    total = x_sq_sum - tf.square(x_sum) / n
+    return (1.0 - residual / total).numpy()
+
+
 def get_filename_from_params(params, epochs):
 
     """ Create a filename from the given parameters.
@@ -202,7 +231,7 @@ class VAECrossValidator:
     def cross_validate(self, data, epochs=200, verbose=1):
         results = []
         # Shuffle and batch the data
-        data = data.shuffle(10000).batch(self.batch_size)
+        data = data.shuffle(10000, reshuffle_each_iteration=True).batch(self.batch_size, drop_remainder=True)
 
         for params in self.param_grid:
             filename = get_filename_from_params(params, epochs)
@@ -242,6 +271,9 @@ class VAECrossValidator:
                     for j in range(2, self.kf.n_splits):
                         train_data = train_data.concatenate(data.shard(self.kf.n_splits, (i+j) % self.kf.n_splits))
 
+                    train_data = train_data.prefetch(tf.data.AUTOTUNE)
+                    val_data = val_data.prefetch(tf.data.AUTOTUNE)
+
                     vae, hist = train_val_vae(vae, train_data, val_data, verbose=verbose, epochs=epochs)
                     val_total_losses.append(np.min(hist.history['val_total_loss']))
                     val_recon_losses.append(np.min(hist.history['val_reconstruction_loss']))
@@ -263,7 +295,7 @@ class VAECrossValidator:
                 metrics['avg_training_losses'] = np.mean(training_losses, axis=0)
                 metrics['avg_kl_losses'] = np.mean(kl_losses, axis=0)
                 with open(savefile, 'wb') as f:
-                    pickle.dump(metrics, f)
+                    pickle.dump(metrics, f, protocol=pickle.HIGHEST_PROTOCOL)
                 save_vae(vae, save_dir)
             results.append((params, metrics))
         return results
@@ -275,7 +307,7 @@ class VAECrossValidator:
                                         'Validation KL Loss History', 'Training Total Loss History',
                                         'Training KL Loss History', 'Training Reconstruction Loss History',
                                         'Parameters'])
-        data = data.shuffle(10000).batch(self.batch_size)
+        data = data.shuffle(10000, reshuffle_each_iteration=True).batch(self.batch_size, drop_remainder=True)
         for params in self.param_grid:
             new_row = {}
             filename = get_filename_from_params(params, epochs)
@@ -316,6 +348,9 @@ class VAECrossValidator:
                     for j in range(2, self.kf.n_splits):
                         train_data = train_data.concatenate(data.shard(self.kf.n_splits, (i+j) % self.kf.n_splits))
 
+                    train_data = train_data.prefetch(tf.data.AUTOTUNE)
+                    val_data = val_data.prefetch(tf.data.AUTOTUNE)
+
                     vae, hist = train_val_vae(vae, train_data, val_data, verbose=verbose, epochs=epochs)
 
                     val_total_losses.append(np.min(hist.history['val_total_loss']))
@@ -349,7 +384,7 @@ class VAECrossValidator:
                     new_row['Initializer'] = params['encoder']['initializer']
 
                     with open(savefile, 'wb') as f:
-                        pickle.dump(new_row, f)
+                        pickle.dump(new_row, f, protocol=pickle.HIGHEST_PROTOCOL)
                     save_vae(vae, save_dir)
             results.loc[len(results)] = new_row
         return results
@@ -361,8 +396,7 @@ class VAECrossValidator:
                                         'Validation KL Loss History', 'Training Total Loss History',
                                         'Training KL Loss History', 'Training Reconstruction Loss History',
                                         'Parameters'])
-        data = train_data.shuffle(10000).batch(self.batch_size)
-        val_data = val_data.batch(val_data.cardinality().numpy())
+        data = train_data.shuffle(10000, reshuffle_each_iteration=True).batch(self.batch_size, drop_remainder=True)
         for params in self.param_grid:
             vae = None
             new_row = {}
@@ -404,6 +438,9 @@ class VAECrossValidator:
                     for j in range(2, self.kf.n_splits):
                         train_data = train_data.concatenate(data.shard(self.kf.n_splits, (i+j) % self.kf.n_splits))
 
+                    train_data = train_data.prefetch(tf.data.AUTOTUNE)
+                    cv_val_data = cv_val_data.prefetch(tf.data.AUTOTUNE)
+
                     vae, hist = train_val_vae(vae, train_data, cv_val_data, verbose=verbose, epochs=epochs)
 
                     val_total_losses.append(np.min(hist.history['val_total_loss']))
@@ -415,8 +452,7 @@ class VAECrossValidator:
                     training_recon_losses.append((hist.history['reconstruction_loss']))
                     training_kl_losses.append(hist.history['kl_loss'])
                     training_total_losses.append(hist.history['total_loss'])
-                    _, r2, _, _ = vae.evaluate(val_data, verbose=verbose)
-                    r2_list.append(r2)
+                    r2_list.append(np.mean(calc_r2_feat(vae, val_data)))
 
                 new_row['Total Loss'] = np.mean(val_total_losses)
                 new_row['Reconstruction Loss'] = np.mean(val_recon_losses)
@@ -438,7 +474,7 @@ class VAECrossValidator:
                 new_row['Initializer'] = params['encoder']['initializer']
 
                 with open(savefile, 'wb') as f:
-                    pickle.dump(new_row, f)
+                    pickle.dump(new_row, f, protocol=pickle.HIGHEST_PROTOCOL)
                 save_vae(vae, save_dir)
             results.loc[len(results)] = new_row
         return results
@@ -535,17 +571,32 @@ class VAECrossValidatorDF:
                 - subset (str): Subset of the data to use. Must be one of 'all', 'thickness', 'volume', or 'thickness_volume'. \n
                 - batch_size (int): Batch size to use for training. \n
                 - lr (float): Learning rate to use for training. \n
+                - weight_decay (float): Decoupled weight decay of the dense kernels. Trains with AdamW instead of Adam. \n
                 - epochs (int): Number of epochs to train for. \n
                 - lr_scheduler (tf.keras.callbacks.LearningRateScheduler): Learning rate scheduler to use for training. \n
         k_folds (int): Number of folds to use for cross validation.
         save_path (str): Path to save the models to.
         test_mode (bool): If True, the cross validation is run in test mode. This means that data is stored when function wrappers are
             called so the data can be inspected.
+        strategy (tf.distribute.Strategy): Distribution strategy the models are built and trained under. The batch size
+            is treated as the per-replica batch size. If None, the default strategy is used.
+        jit_compile (bool): If True, the train and test steps of the models are compiled with XLA. Ignored when the
+            strategy has more than one replica.
+        seed (int): Seed of the fold split and the latent sampling noise. The noise of fold i is seeded with seed + i,
+            so the folds are reproducible. If None, neither is seeded.
+        data_cache_dir (str): (optional) Directory the preprocessed data is saved to and reused from, see
+            utils.generate_data.
     """
-    def __init__(self, param_df: pd.DataFrame, k_folds: int = 5, save_path: str = None, test_mode: bool = False):
+    def __init__(self, param_df: pd.DataFrame, k_folds: int = 5, save_path: str = None, test_mode: bool = False,
+                 strategy: tf.distribute.Strategy = None, jit_compile: bool = False, seed: int = 42,
+                 data_cache_dir: str = None):
         self.param_df = param_df
         self.save_path = save_path
-        self.kf = KFold(n_splits=k_folds)
+        self.kf = KFold(n_splits=k_folds, shuffle=True, random_state=seed)
+        self.strategy = strategy or tf.distribute.get_strategy()
+        self.jit_compile = jit_compile
+        self.seed = seed
+        self.data_cache_dir = data_cache_dir
         self.generate_data_params = [] # For testing purposes
         self.train_val_vae_params = [] # For testing purposes
         self.test_mode = test_mode # For testing purposes
@@ -588,6 +639,9 @@ class VAECrossValidatorDF:
         param_df_columns = list(self.param_df.keys())
         results = pd.DataFrame(columns=list(self.param_df.keys()) + other_columns)
 
+        # The folds of each data set are built once for every batch size and shared by the rows using them
+        fold_datasets = {}
+
         for j, row in tqdm(self.param_df.iterrows(), total=len(self.param_df), desc="Model Progress", ncols=80):
             best_cv_total_loss = []
             best_cv_recon_loss = []
@@ -601,46 +655,76 @@ class VAECrossValidatorDF:
             training_kl_hist = []
             validation_feat_r2 = []
 
+            data_key = None
             if "normalization" in self.param_df.columns and "subset" in self.param_df.columns:
-                train, val, test, labels = data_sets[(row["normalization"], row["subset"])]
+                data_key = (row["normalization"], row["subset"])
             elif "normalization" in self.param_df.columns:
-                train, val, test, labels = data_sets[row["normalization"]]
+                data_key = row["normalization"]
             elif "subset" in self.param_df.columns:
-                train, val, test, labels = data_sets[row["subset"]]
+                data_key = row["subset"]
+            if data_key is not None:
+                train, val, test, labels = data_sets[data_key]
                 
             if "batch_size" in self.param_df.columns:
-                data = train.shuffle(10000).batch(row["batch_size"])
+                batch_size = row["batch_size"]
             else:
-                data = train.shuffle(10000).batch(256)
-            val_data = val.batch(val.cardinality().numpy())
-
-            for i in tqdm(range(self.kf.n_splits), desc="Fold Progress", ncols=80, disable = True if verbose < 1 else False):
-                vae = None
-                input_dim = train.element_spec[0].shape[0]
-                cov_dim = train.element_spec[1].shape[0]
+                batch_size = 256
+            global_batch_size = batch_size * self.strategy.num_replicas_in_sync
+            if (data_key, global_batch_size) not in fold_datasets:
+                fold_datasets[(data_key, global_batch_size)] = self.create_fold_datasets(train, global_batch_size)
+            folds = fold_datasets[(data_key, global_batch_size)]
+
+            input_dim = train.element_spec[0].shape[0]
+            cov_dim = train.element_spec[1].shape[0]
+            with self.strategy.scope():
                 if(row["conditioning"]):
-                    encoder = create_vae_encoder(input_dim + cov_dim, row["h_dim"], row["z_dim"], row["activation"], 
+                    encoder = create_vae_encoder(input_dim + cov_dim, row["h_dim"], row["z_dim"], row["activation"],
                                                 row["initializer"], row["dropout"])
                     decoder = create_vae_decoder(row["z_dim"] + cov_dim, row["h_dim"], input_dim, row["activation"],
                                                 row["initializer"], row["dropout"])
-                    vae = VAE(encoder, decoder, row['beta'], cov=True)
+                    vae = VAE(encoder, decoder, row['beta'], cov=True, seed=self.seed)
                 else:
-                    encoder = create_vae_encoder(input_dim, row["h_dim"], row["z_dim"], row["activation"], 
+                    encoder = create_vae_encoder(input_dim, row["h_dim"], row["z_dim"], row["activation"],
                                                 row["initializer"], row["dropout"])
                     decoder = create_vae_decoder(row["z_dim"], row["h_dim"], input_dim, row["activation"],
                                                 row["initializer"], row["dropout"])
-                    vae = VAE(encoder, decoder, row['beta'], cov=False)
-
-                if("lr" in self.param_df.columns):
-                    vae.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=row["lr"]))
+                    vae = VAE(encoder, decoder, row['beta'], cov=False, seed=self.seed)
+
+                if "weight_decay" in self.param_df.columns:
+                    learning_rate = row["lr"] if "lr" in self.param_df.columns else 1e-4
+                    optimizer = tf.keras.optimizers.AdamW(learning_rate=learning_rate,
+                                                          weight_decay=row["weight_decay"])
+                    # Only decay the dense kernels, as an L2 kernel regularizer would
+                    optimizer.exclude_from_weight_decay(var_names=['bias', 'gamma', 'beta'])
+                elif("lr" in self.param_df.columns):
+                    optimizer = tf.keras.optimizers.Adam(learning_rate=row["lr"])
                 else:
-                    vae.compile()
-                
-                cv_val_data = data.shard(self.kf.n_splits, i)
-                train_data = data.shard(self.kf.n_splits, (i+1) % self.kf.n_splits)
+                    optimizer = None
+                # XLA cannot access the variables of the other replicas under a MirroredStrategy
+                vae.compile(optimizer=optimizer,
+                            jit_compile=self.jit_compile and self.strategy.num_replicas_in_sync == 1)
+                # The model is built and compiled once, and reset to its initial state for every fold, so the train
+                # and test functions traced on the first fold are reused by the rest
+                vae.optimizer.build(vae.trainable_variables)
+            initial_weights = vae.get_weights()
+            optimizer_variables = list(vae.optimizer.variables)
+            # The dynamic loss scale of a mixed precision optimizer is not among its variables
+            if isinstance(vae.optimizer, tf.keras.mixed_precision.LossScaleOptimizer) and vae.optimizer.dynamic:
+                optimizer_variables += [vae.optimizer._loss_scale.current_loss_scale, vae.optimizer.dynamic_counter]
+            initial_optimizer_weights = [v.numpy() for v in optimizer_variables]
+            optimizer_lr = vae.optimizer.learning_rate
+            initial_lr = optimizer_lr.numpy() if isinstance(optimizer_lr, tf.Variable) else None
 
-                for k in range(2, self.kf.n_splits):
-                    train_data = train_data.concatenate(data.shard(self.kf.n_splits, (i+k) % self.kf.n_splits))
+            for i in tqdm(range(self.kf.n_splits), desc="Fold Progress", ncols=80, disable = True if verbose < 1 else False):
+                vae.set_weights(initial_weights)
+                for variable, value in zip(optimizer_variables, initial_optimizer_weights):
+                    variable.assign(value)
+                if initial_lr is not None:
+                    vae.optimizer.learning_rate.assign(initial_lr)
+                if self.seed is not None:
+                    vae.rng.reset_from_seed(self.seed + i)
+
+                train_data, cv_val_data = folds[i]
 
                 if "lr_scheduler" in self.param_df.columns:
                     callbacks = [row["lr_scheduler"]]
@@ -668,8 +752,7 @@ class VAECrossValidatorDF:
                 training_kl_hist.append(hist.history['kl_loss'])
 
                 # Fixed validation set R2 performance from each fold
-                val_dict = vae.evaluate(val_data, verbose=verbose-1, return_dict=True)
-                validation_feat_r2.append(val_dict['r2_feat'])
+                validation_feat_r2.append(calc_r2_feat(vae, val))
             
             # Average metrics from all folds
             row["avg_best_cv_total_loss"] = np.mean(best_cv_total_loss)
@@ -691,9 +774,37 @@ class VAECrossValidatorDF:
                 if not os.path.exists(self.save_path):
                     os.makedirs(self.save_path)
                 with open(os.path.join(self.save_path, 'results.pkl'), 'wb') as f:
-                    pickle.dump(results, f)
+                    pickle.dump(results, f, protocol=pickle.HIGHEST_PROTOCOL)
         return results
     
+    def create_fold_datasets(self, data: tf.data.Dataset, batch_size: int) -> list:
+        """ Split the data into the training and validation datasets of each cross validation fold.
+
+        The data is held once as a pair of tensors, and each fold gathers its batches from them by index, so the folds
+        are disjoint and fixed across epochs without copying the data for every fold.
+
+        Args:
+            data (tf.data.Dataset): Unbatched dataset of (x, y) pairs to split.
+            batch_size (int): Batch size of the fold datasets. Incomplete training batches are dropped so the batch
+                dimension is static.
+
+        Returns: A list with a (train, validation) tuple of batched datasets for each fold.
+        """
+        x, y = next(iter(data.batch(data.cardinality().numpy())))
+
+        def gather(idx):
+            return tf.gather(x, idx), tf.gather(y, idx)
+
+        folds = []
+        for train_idx, val_idx in self.kf.split(np.arange(x.shape[0])):
+            train_data = tf.data.Dataset.from_tensor_slices(train_idx).shuffle(len(train_idx),
+                                                                               reshuffle_each_iteration=True)
+            train_data = train_data.batch(batch_size, drop_remainder=True).map(gather).prefetch(tf.data.AUTOTUNE)
+            val_data = tf.data.Dataset.from_tensor_slices(val_idx).batch(batch_size).map(gather)
+            val_data = val_data.prefetch(tf.data.AUTOTUNE)
+            folds.append((train_data, val_data))
+        return folds
+
     def generate_data_wrapper(self, **kwargs):
         """ Wrapper for generate_data that stores the parameters when generate_data is called
          This method is used for testing.
@@ -705,7 +816,7 @@ class VAECrossValidatorDF:
         """
         if self.test_mode:
             self.generate_data_params.append(kwargs)
-        return generate_data(**kwargs)
+        return generate_data(cache_dir=self.data_cache_dir, **kwargs)
     
     def train_val_vae_wrapper(self, **kwargs):
         """ Wrapper for train_val_vae that stores the parameters when train_val_vae is called
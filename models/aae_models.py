@@ -340,13 +340,13 @@ class AAE(keras.Model):
             "gen_lr": self.optimizer.generator_optimizer.lr,
         }
 
-    def eval(self, data):
-        data = data.batch(len(data))
-        batch = next(iter(data))
-        output = self(batch)
-        x, _ = batch
-        results = tf.keras.metrics.MSE(x, output)
-        return results
+    def eval(self, data, batch_size=1024):
+        # Reconstruct the data in batches rather than as one batch of the whole dataset
+        results = []
+        for batch in data.batch(batch_size):
+            x, _ = batch
+            results.append(tf.keras.metrics.MSE(x, self(batch)))
+        return tf.concat(results, axis=0)
 
     def call(self, data, training=False, mask=None):
         x, y = data
@@ -1,3 +1,4 @@
+import math
 import tensorflow as tf
 from tensorflow import keras
 
@@ -19,18 +20,22 @@ def create_vae_encoder(input_dim, hidden_dim, latent_dim, activation='relu', ini
     inputs = keras.layers.Input(shape=(input_dim,))
     x = inputs
     for h_dim in hidden_dim:
-        x = keras.layers.Dense(h_dim, kernel_initializer=initializer)(x)
+        # The batch normalization offset takes the place of the dense bias
+        x = keras.layers.Dense(h_dim, kernel_initializer=initializer, use_bias=False)(x)
         x = keras.layers.BatchNormalization()(x)
         x = keras.layers.Activation(activation)(x)
         x = keras.layers.Dropout(dropout_rate)(x)
+    # The latent heads are kept in float32 so the sampling and KL loss stay stable under mixed precision
     mu = keras.layers.Dense(
         latent_dim,
         activation='linear',
-        kernel_initializer=initializer)(x)
+        kernel_initializer=initializer,
+        dtype='float32')(x)
     log_var = keras.layers.Dense(
         latent_dim,
         activation='linear',
-        kernel_initializer=initializer)(x)
+        kernel_initializer=initializer,
+        dtype='float32')(x)
 
     model = keras.Model(inputs, [mu, log_var], name='VAEEncoder')
     return model
@@ -66,8 +71,9 @@ def create_vae_decoder(latent_dim, hidden_dim, output_dim, activation='relu', in
         x = keras.layers.Activation(activation)(x)
         x = keras.layers.Dropout(dropout_rate)(x)
 
-    # Add the output layer
-    decoder_output = keras.layers.Dense(output_dim, activation='linear', kernel_initializer=initializer)(x)
+    # Add the output layer, in float32 so the reconstruction loss is computed at full precision
+    decoder_output = keras.layers.Dense(output_dim, activation='linear', kernel_initializer=initializer,
+                                        dtype='float32')(x)
 
     # Define the model
     decoder = keras.Model(decoder_input, decoder_output, name='VAEDecoder')
@@ -93,6 +99,29 @@ def calc_kl_loss(mu, log_var):
     return loss
 
 
+def sample_latent(mu, log_var, epsilon):
+    """Samples the latent space of a Variational Autoencoder and calculates the KL divergence of each sample
+
+    The sample is drawn with the reparameterization trick, z = mu + sigma * epsilon. The variance is computed once and
+    shared by both. It is clipped to the range of a log variance in [-10, 10] for sigma only, so a diverging encoder
+    cannot produce infinite samples. The KL divergence uses the unclipped variance, so it matches calc_kl_loss before the
+    mean over the batch and keeps pulling the log variance back into range.
+
+    Args:
+        mu (tensor): The mean of the latent distribution
+        log_var (tensor): The log variance of the latent distribution
+        epsilon (tensor): Standard normal noise with the same shape as mu
+
+    Returns: The latent sample, and the KL divergence between the latent distribution and a standard normal
+    distribution for each sample in the batch
+    """
+    var = tf.exp(log_var)
+    sigma = tf.sqrt(tf.clip_by_value(var, math.exp(-10.0), math.exp(10.0)))
+    z = mu + sigma * epsilon
+    kl = 0.5 * tf.reduce_sum(tf.square(mu) + var - log_var - 1.0, axis=1)
+    return z, kl
+
+
 def r2_score(y_true, y_predicted):
     """Calculates the R2 score
 
@@ -140,6 +169,7 @@ class VAE(keras.Model):
     Args:
         encoder (VAEEncoder): The encoder model
         decoder (VAEDecoder): The decoder model
+        seed (int): (optional) Seed for the latent sampling noise. A non-deterministic seed is used if None
 
     Attributes:
         encoder (VAEEncoder): The encoder model
@@ -149,13 +179,15 @@ class VAE(keras.Model):
         optimizer (tf.keras.optimizers.Optimizer): The optimizer to use to train the model
         beta (float): The weight to use for the KL divergence loss
         cov (bool): Whether or not to use the covariance matrix as input to the decoder
+        rng (tf.random.Generator): The generator used to sample the latent noise
     """
     def __init__(
             self,
             encoder,
             decoder,
             beta=1,
-            cov=True
+            cov=True,
+            seed=None
     ):
         super(VAE, self).__init__()
         self.encoder = encoder
@@ -165,6 +197,11 @@ class VAE(keras.Model):
         self.optimizer = None
         self.beta = beta
         self.cov = cov
+        # Generator state is an explicit variable, so sampling can be compiled by XLA and split across replicas
+        if seed is None:
+            self.rng = tf.random.Generator.from_non_deterministic_state()
+        else:
+            self.rng = tf.random.Generator.from_seed(seed)
 
     def compile(
             self,
@@ -175,19 +212,36 @@ class VAE(keras.Model):
     ):
         super(VAE, self).compile(**kwargs)
         self.optimizer = optimizer or tf.keras.optimizers.Adam(learning_rate=1e-4)
+        # Scale the loss to keep float16 gradients from underflowing
+        if (keras.mixed_precision.global_policy().name == 'mixed_float16' and
+                not isinstance(self.optimizer, keras.mixed_precision.LossScaleOptimizer)):
+            self.optimizer = keras.mixed_precision.LossScaleOptimizer(self.optimizer)
         self.reconstruction_loss_fn = reconstruction_loss_fn
         self.kl_loss_fn = kl_loss_fn
+        # The reconstruction loss is kept per sample so its mean can be taken over the global batch under a
+        # distribution strategy
+        if isinstance(reconstruction_loss_fn, tf.keras.losses.Loss):
+            config = dict(reconstruction_loss_fn.get_config(), reduction=tf.keras.losses.Reduction.NONE)
+            self._sample_reconstruction_loss_fn = type(reconstruction_loss_fn).from_config(config)
+        else:
+            self._sample_reconstruction_loss_fn = reconstruction_loss_fn
+        # The step outputs are reduced across replicas in the steps themselves
+        self.distribute_reduction_method = 'first'
 
     def train_step(self, batch_data):
         x, y = batch_data
+        global_batch_size = self._global_batch_size(x)
         with tf.GradientTape() as tape:
-            z_mean, z_log_var, z, x_reconstructed = self(batch_data, training=True)
-            reconstruction_loss = self.reconstruction_loss_fn(x, x_reconstructed)
-            kl_loss = tf.reduce_mean(self.kl_loss_fn(z_mean, z_log_var))
+            z_mean, z_log_var, z, x_reconstructed, kl = self(batch_data, training=True, return_kl=True)
+            reconstruction_loss = tf.nn.compute_average_loss(self._sample_reconstruction_loss_fn(x, x_reconstructed),
+                                                             global_batch_size=global_batch_size)
+            kl_loss = self._kl_loss(z_mean, z_log_var, kl, global_batch_size)
             total_loss = reconstruction_loss + self.beta * kl_loss
-            grads = tape.gradient(total_loss, self.trainable_weights)
-
-            self.optimizer.apply_gradients(zip(grads, self.trainable_weights))
+        # Each replica holds its share of the global batch loss, and the gradients are summed across replicas when
+        # applied. minimize applies the loss scaling when the optimizer is a LossScaleOptimizer
+        self.optimizer.minimize(total_loss, self.trainable_weights, tape=tape)
+        reconstruction_loss, kl_loss, total_loss = tf.distribute.get_replica_context().all_reduce(
+            tf.distribute.ReduceOp.SUM, [reconstruction_loss, kl_loss, total_loss])
         return {
             "reconstruction_loss": reconstruction_loss,
             "kl_loss": kl_loss,
@@ -198,11 +252,18 @@ class VAE(keras.Model):
 
     def test_step(self, batch_data):
         x, y = batch_data
-        z_mean, z_log_var, z, x_reconstructed = self(batch_data, training=False)
-        reconstruction_loss = self.reconstruction_loss_fn(x, x_reconstructed)
-        kl_loss = tf.reduce_mean(self.kl_loss_fn(z_mean, z_log_var))
+        global_batch_size = self._global_batch_size(x)
+        z_mean, z_log_var, z, x_reconstructed, kl = self(batch_data, training=False, return_kl=True)
+        reconstruction_loss = tf.nn.compute_average_loss(self._sample_reconstruction_loss_fn(x, x_reconstructed),
+                                                         global_batch_size=global_batch_size)
+        kl_loss = self._kl_loss(z_mean, z_log_var, kl, global_batch_size)
         total_loss = reconstruction_loss + kl_loss
-        x = tf.cast(x, dtype=tf.float32)
+        replica_context = tf.distribute.get_replica_context()
+        reconstruction_loss, kl_loss, total_loss = replica_context.all_reduce(
+            tf.distribute.ReduceOp.SUM, [reconstruction_loss, kl_loss, total_loss])
+        # The R2 scores are calculated over the global batch
+        x = replica_context.all_gather(tf.cast(x, dtype=tf.float32), axis=0)
+        x_reconstructed = replica_context.all_gather(x_reconstructed, axis=0)
         r2 = r2_score(x, x_reconstructed)
         r2_feat = r2_feat_score(x, x_reconstructed)
         return {
@@ -213,22 +274,39 @@ class VAE(keras.Model):
             "r2_feat": r2_feat
         }
 
-    def call(self, data, training=False, mask=None):
+    @staticmethod
+    def _global_batch_size(x):
+        # Summed across replicas, since the last batch of a dataset may not split evenly
+        return tf.distribute.get_replica_context().all_reduce(tf.distribute.ReduceOp.SUM, tf.shape(x)[0])
+
+    def _kl_loss(self, z_mean, z_log_var, kl, global_batch_size):
+        # The default KL divergence is already computed per sample alongside the latent sample
+        if self.kl_loss_fn is calc_kl_loss:
+            return tf.nn.compute_average_loss(kl, global_batch_size=global_batch_size)
+        # Other KL losses are averaged over the replica batch, so weight them by the replica share of the global batch
+        batch_fraction = tf.cast(tf.shape(z_mean)[0], z_mean.dtype) / tf.cast(global_batch_size, z_mean.dtype)
+        return tf.reduce_mean(self.kl_loss_fn(z_mean, z_log_var)) * batch_fraction
+
+    def call(self, data, training=False, mask=None, return_kl=False):
         x, y = data
         if self.cov:
             x_cov = tf.concat([x, y], axis=-1)
             z_mean, z_log_var = self.encoder(x_cov, training=training)
         else:
             z_mean, z_log_var = self.encoder(x, training=training)
-        batch = tf.shape(z_mean)[0]
-        dim = tf.shape(z_mean)[1]
-        epsilon = tf.keras.backend.random_normal(shape=(batch, dim))
-        z = z_mean + tf.exp(0.5 * z_log_var) * epsilon
+        # Use the static batch size when it is known, as with datasets batched with drop_remainder, so the graph
+        # does not read the shape at run time
+        batch = z_mean.shape[0] if z_mean.shape[0] is not None else tf.shape(z_mean)[0]
+        dim = z_mean.shape[1]
+        epsilon = self.rng.normal(shape=(batch, dim), dtype=z_mean.dtype)
+        z, kl = sample_latent(z_mean, z_log_var, epsilon)
         if self.cov:
-            z_cov = tf.concat([z, y], axis=-1)
+            z_cov = tf.concat([z, tf.cast(y, z.dtype)], axis=-1)
             x_reconstructed = self.decoder(z_cov, training=training)
         else:
             x_reconstructed = self.decoder(z, training=training)
+        if return_kl:
+            return z_mean, z_log_var, z, x_reconstructed, kl
         return z_mean, z_log_var, z, x_reconstructed
 
     def get_config(self):
@@ -1,11 +1,19 @@
+import functools
+import hashlib
+import os
+import tempfile
 import pandas as pd
 import numpy as np
-from sklearn.preprocessing import OneHotEncoder, StandardScaler, MinMaxScaler
+from sklearn.preprocessing import StandardScaler, MinMaxScaler
 from sklearn.model_selection import train_test_split
 import tensorflow as tf
 
+# Version of the preprocessed arrays saved by generate_data. Bump it whenever _preprocess_data changes its output, so
+# files saved by an older version are not loaded
+PREPROCESSED_VERSION = 1
 
-def generate_data(filepath: str, split: float = 0.2, normalize: int = 1, subset: str = 'all'):
+
+def generate_data(filepath: str, split: float = 0.2, normalize: int = 1, subset: str = 'all', cache_dir: str = None):
     """
     Generate data to be used in model training. Splits the data from the specified csv file into training,
     test and validation sets
@@ -17,19 +25,50 @@ def generate_data(filepath: str, split: float = 0.2, normalize: int = 1, subset:
          normalization, 3 for min-max normalization
         subset (str): Subset of the data to use. 'all' for all data, 'thickness' for thickness data only, 'volume' for
             volume data only, 'thickness_volume' for both thickness and volume data
+        cache_dir (str): (optional) Directory to save the preprocessed data to. Later calls with the same arguments load
+            it from there while the csv file is unchanged
     
     Returns: Tuple of tf.data.Dataset objects containing the training, validation and test data in that order, and the
         names of the columns in the data
     """
-    db = pd.read_csv(filepath)
-    enc_sex = OneHotEncoder(sparse_output=False)
-    enc_age = OneHotEncoder(sparse_output=False)
-    one_hot_sex = enc_sex.fit_transform(db['sex'].values.reshape(-1, 1))
-    age = db[['age']].round(0)
-    one_hot_age = enc_age.fit_transform(age['age'].values.reshape(-1, 1))
-
-    # Get the indices matching a condition on a feature
-    condition_indices = db[db['dcode'] == 0].index
+    if cache_dir is None:
+        arrays = _preprocess_data(filepath, split, normalize, subset)
+    else:
+        cache_file = os.path.join(cache_dir, _preprocessed_filename(filepath, split, normalize, subset))
+        if os.path.exists(cache_file):
+            with np.load(cache_file) as cached:
+                arrays = dict(cached)
+        else:
+            arrays = _preprocess_data(filepath, split, normalize, subset)
+            os.makedirs(cache_dir, exist_ok=True)
+            # Save to a temporary file first, so an interrupted save never leaves a partial file at the cached path
+            fd, tmp_file = tempfile.mkstemp(suffix='.npz', dir=cache_dir)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    np.savez(f, **arrays)
+                os.replace(tmp_file, cache_file)
+            except BaseException:
+                os.remove(tmp_file)
+                raise
+
+    train = tf.data.Dataset.from_tensor_slices((arrays['train_x'], arrays['train_y']))
+    val = tf.data.Dataset.from_tensor_slices((arrays['val_x'], arrays['val_y']))
+    test = tf.data.Dataset.from_tensor_slices((arrays['test_x'], arrays['test_y']))
+    return train, val, test, pd.Index(arrays['columns'], dtype=object)
+
+
+def _preprocess_data(filepath, split, normalize, subset):
+    """
+    Split and normalize the data of a csv file, as described in generate_data
+
+    Returns: A dictionary of the train, val and test arrays of the features (x) and covariates (y), and the column names
+    """
+    db = _read_csv(filepath)
+    one_hot_sex = one_hot_encode(db['sex'].to_numpy())
+    one_hot_age = one_hot_encode(np.round(db['age'].to_numpy()))
+
+    # Get the mask matching a condition on a feature
+    condition_mask = (db['dcode'] == 0).to_numpy()
     db = db.drop(['age', 'sex', 'scanner', 'euler', 'BrainSegVolNotVent', 'euler_med', 'sample', 'dcode',
                   'timepoint','lh_MeanThickness_thickness', 'rh_MeanThickness_thickness'], axis=1, inplace=False)
 
@@ -48,21 +87,23 @@ def generate_data(filepath: str, split: float = 0.2, normalize: int = 1, subset:
     else:
         raise ValueError("Invalid subset. Must be one of 'all', 'thickness', 'volume', 'thickness_volume'")
     
-    # Create two new datasets based on the condition indices
-    train_x = data.loc[condition_indices]
-    test_x = data.loc[~db.index.isin(condition_indices)]
+    # Create two new datasets based on the condition mask. The arrays are kept column-major, as pandas stores them,
+    # since the normalization reduces over columns
+    data_x = data.to_numpy()
+    train_x = np.asfortranarray(data_x[condition_mask])
+    test_x = np.asfortranarray(data_x[~condition_mask])
 
     y_data = np.concatenate((one_hot_age, one_hot_sex), axis=1).astype('float32')
 
     if normalize == 0:
-        train_x_norm = train_x.to_numpy().astype('float64')
-        test_x_norm = test_x.to_numpy().astype('float64')
+        train_x_norm = train_x.astype('float64')
+        test_x_norm = test_x.astype('float64')
     elif normalize == 1:
         scaler = StandardScaler()
         train_x_norm = scaler.fit_transform(train_x)
         test_x_norm = scaler.transform(test_x)
     elif normalize == 2:
-        global_mean_train_x = train_x.values.mean()
+        global_mean_train_x = train_x.mean()
         train_x_norm = train_x - global_mean_train_x
         test_x_norm = test_x - global_mean_train_x
     elif normalize == 3:
@@ -72,18 +113,67 @@ def generate_data(filepath: str, split: float = 0.2, normalize: int = 1, subset:
     else:
         raise ValueError("Invalid normalization method. Must be an integer from 0 - 3")
 
-    train_y = y_data[condition_indices, :]
-    test_y = y_data[~db.index.isin(condition_indices), :]
+    train_y = y_data[condition_mask]
+    test_y = y_data[~condition_mask]
 
     train_x, val_x, train_y, val_y = train_test_split(train_x_norm, train_y, test_size=split, shuffle=False, random_state=42)
-    val = tf.data.Dataset.from_tensor_slices((val_x, val_y))
-    train = tf.data.Dataset.from_tensor_slices((train_x, train_y))
-    test = tf.data.Dataset.from_tensor_slices((test_x_norm, test_y))
+    return {
+        'train_x': train_x, 'train_y': train_y,
+        'val_x': val_x, 'val_y': val_y,
+        'test_x': test_x_norm, 'test_y': test_y,
+        'columns': data.columns.to_numpy(dtype=str)
+    }
+
+
+def _preprocessed_filename(filepath, split, normalize, subset):
+    # The csv path and modification time identify the file the arrays were computed from
+    path_hash = hashlib.md5(os.path.abspath(filepath).encode()).hexdigest()[:8]
+    mtime = os.stat(filepath).st_mtime_ns
+    name = os.path.splitext(os.path.basename(filepath))[0]
+    return f"{name}_{path_hash}_{mtime}_split{split}_norm{normalize}_{subset}_v{PREPROCESSED_VERSION}.npz"
+
+
+def _read_csv(filepath):
+    """
+    Read a csv file, reusing the parsed frame while the file is unchanged. The frame is shared between calls, so it
+    must not be modified in place
+
+    Args:
+        filepath (str): path to the csv file
+
+    Returns: A pd.DataFrame of the file contents
+    """
+    return _read_csv_cached(os.path.abspath(filepath), os.path.getmtime(filepath))
+
+
+@functools.lru_cache(maxsize=4)
+def _read_csv_cached(filepath, mtime):
+    return pd.read_csv(filepath)
+
+
+def one_hot_encode(values):
+    """
+    One-hot encode a 1D array of categorical values. Categories are ordered by their sorted unique values, and missing
+    values are encoded as a category of their own after the others, matching sklearn's OneHotEncoder
+
+    Args:
+        values (np.ndarray): The values to encode
+
+    Returns: A (len(values), n_categories) float64 array of one-hot rows
+    """
+    categorical = pd.Categorical(values)
+    codes = categorical.codes
+    n_categories = len(categorical.categories)
+    # Missing values have the code -1
+    missing = codes == -1
+    if missing.any():
+        codes = np.where(missing, n_categories, codes)
+        n_categories += 1
+    return np.eye(n_categories)[codes]
 
-    return train, val, test, data.columns
 
 def generate_feature_names(filepath):
-    db = pd.read_csv(filepath)
+    db = _read_csv(filepath)
     db = db.drop(['age', 'sex', 'scanner', 'euler', 'BrainSegVolNotVent', 'euler_med', 'sample', 'dcode',
                   'timepoint'], axis=1, inplace=False)
     return db.columns
@@ -1,4 +1,5 @@
 import vis_utils as vu
+from modelUtils.vae_utils import calc_r2_feat
 from sklearn.cluster import KMeans
 from sklearn.metrics import silhouette_samples
 import numpy as np
@@ -7,6 +8,33 @@ from matplotlib.image import imread
 import tensorflow as tf
 
 
+class _CachedForwardPass:
+    """ Wraps a VAE model so that repeated forward passes over the same data reuse the first result
+
+    Calls with the same data object and no extra arguments return the outputs of the first call, so every visualization
+    in an analysis shares one latent sample. All other attributes, such as the decoder, are taken from the model.
+
+    Args:
+        model: The VAE model to wrap
+    """
+    def __init__(self, model):
+        self._model = model
+        self._outputs = {}
+
+    def __call__(self, data, **kwargs):
+        if kwargs:
+            return self._model(data, **kwargs)
+        # The data is stored with its outputs so its id cannot be reused while it is cached
+        cached = self._outputs.get(id(data))
+        if cached is None:
+            cached = (data, self._model(data))
+            self._outputs[id(data)] = cached
+        return cached[1]
+
+    def __getattr__(self, name):
+        return getattr(self._model, name)
+
+
 class VAEModelAnalyzer:
     """ Class for analyses of VAE models
 
@@ -47,51 +75,51 @@ class VAEModelAnalyzer:
         Args:
             save_path: The path to save the visualizations to
         """
+        # Every visualization encodes and reconstructs the same validation and test data
+        model = _CachedForwardPass(self.model)
 
         # P1
-        vu.plot_latent_dimensions(self.model, self.val_data, z_dim=self.z, savefile=save_path + '/latent_dimensions.png')
+        vu.plot_latent_dimensions(model, self.val_data, z_dim=self.z, savefile=save_path + '/latent_dimensions.png')
 
         # P2
         if self.z == 3:
-            vu.visualize_latent_space_3d(self.model, self.val_data, test_data=self.test_data,
+            vu.visualize_latent_space_3d(model, self.val_data, test_data=self.test_data,
                                          savefile=save_path + '/latent_space.png')
-            vu.visualize_top_clusters_3d(self.model, self.val_data, num_clusters=30, top_k=5,
+            vu.visualize_top_clusters_3d(model, self.val_data, num_clusters=30, top_k=5,
                                          savefile=save_path + '/top_5_clusters.png')
         else:
-            vu.visualize_latent_space(self.model, self.val_data, test_data=self.test_data,
+            vu.visualize_latent_space(model, self.val_data, test_data=self.test_data,
                                       savefile=save_path + '/latent_space.png')
-            vu.visualize_top_clusters(self.model, self.val_data, num_clusters=30, top_k=5,
+            vu.visualize_top_clusters(model, self.val_data, num_clusters=30, top_k=5,
                                       savefile=save_path + '/top_5_clusters.png')
 
         # P3
-        vu.visualize_latent_interpolation_chaos(self.model, self.val_data, feat_labels=self.feat_labels,
+        vu.visualize_latent_interpolation_chaos(model, self.val_data, feat_labels=self.feat_labels,
                                                 z_dim=self.z, savefile=save_path + '/latent_interpolation.png')
-        vu.visualize_latent_influence(self.model, self.val_data, z_dim=self.z,
+        vu.visualize_latent_influence(model, self.val_data, z_dim=self.z,
                                       savefile=save_path + '/latent_influence.png')
-        vu.latent_gradient_attribution(self.model, self.val_data, z_dim=self.z,
+        vu.latent_gradient_attribution(model, self.val_data, z_dim=self.z,
                                        savefile=save_path + '/latent_gradient.png')
 
         # P4
         rec_data = tf.data.Dataset.from_tensor_slices(self.val_data)
-        batched_data = rec_data.batch(rec_data.cardinality().numpy())
-        hist = self.model.evaluate(batched_data, return_dict=True)
-        self.model_results["R2"] = np.mean(hist['r2_feat'][-1])
-        vu.visualize_errors_hist(self.model, self.val_data, savefile=save_path + '/errors_hist.png')
-        vu.visualize_feat_errors_hist(self.model, self.val_data, savefile=save_path + '/feat_errors_hist.png')
-        self.model_results["Feature Errors"] = vu.calc_feature_errors(self.model, self.val_data,
+        self.model_results["R2"] = np.mean(calc_r2_feat(self.model, rec_data))
+        vu.visualize_errors_hist(model, self.val_data, savefile=save_path + '/errors_hist.png')
+        vu.visualize_feat_errors_hist(model, self.val_data, savefile=save_path + '/feat_errors_hist.png')
+        self.model_results["Feature Errors"] = vu.calc_feature_errors(model, self.val_data,
                                                                       feat_labels=self.feat_labels,
                                                                       savefile=save_path + '/feature_errors.csv')
 
         # P5
-        vu.visualize_reconstruction_errors(self.model, self.val_data, num_recon=6, savefile=save_path + '/recon_errors.png')
-        vu.visualize_feature_errors(self.model, self.val_data, num_recon=6, feat_labels=self.feat_labels, random=True,
+        vu.visualize_reconstruction_errors(model, self.val_data, num_recon=6, savefile=save_path + '/recon_errors.png')
+        vu.visualize_feature_errors(model, self.val_data, num_recon=6, feat_labels=self.feat_labels, random=True,
                                     savefile=save_path + '/feature_errors.png')
-        vu.top_recon_error_visualization(self.model, self.val_data, savefile=save_path + '/top_recon_errors.png')
-        vu.top_feat_error_visualization(self.model, self.val_data, feat_labels=self.feat_labels,
+        vu.top_recon_error_visualization(model, self.val_data, savefile=save_path + '/top_recon_errors.png')
+        vu.top_feat_error_visualization(model, self.val_data, feat_labels=self.feat_labels,
                                         savefile=save_path + '/top_feat_errors.png')
 
         if self.test_data is not None:
-            vu.visualize_latent_space(self.model, self.val_data, test_data=self.test_data,
+            vu.visualize_latent_space(model, self.val_data, test_data=self.test_data,
                                       savefile=save_path + '/latent_space_test.png')
 
         if self.hist is not None: